@@ -14,18 +14,24 @@ import struct
 import hashlib
 import os
 import sys
-from six import BytesIO, PY3
+from functools import partial
 
 try:
     import snappy
     # there is a different library called "snappy" that is NOT the compression library
     # hence even on successful import we test if this "snappy" is the correct one
-    if "foo" != snappy.decompress(snappy.compress("foo")):
+    if b"foo" != snappy.decompress(snappy.compress(b"foo")):
         raise Exception("Snappy is not capable of compressing data!")
     HAVE_SNAPPY = True
 except:
     HAVE_SNAPPY = False
 
+try:
+    import lz4.block
+    HAVE_LZ4 = True
+except ImportError:
+    HAVE_LZ4 = False
+
 from pymonetdb.exceptions import OperationalError, DatabaseError,\
     ProgrammingError, NotSupportedError, IntegrityError
 
@@ -42,14 +48,39 @@ class Endianness:
     little = 1
     big = 2
 
+
+BYTE_ORDER = Endianness.little if sys.byteorder == 'little' else Endianness.big
+
+
 def get_byte_order():
-    import sys
-    return Endianness.little if sys.byteorder == 'little' else Endianness.big
+    return BYTE_ORDER
 
 logger = logging.getLogger(__name__)
 
 MAX_PACKAGE_LENGTH = (1024 * 8) - 2
 
+# chunk headers: chunk length shifted left by one, lowest bit marks the last chunk
+PROT9_HEADER = struct.Struct('<H')  # little endian short
+PROT10_HEADER = struct.Struct('<q')  # little endian long long
+
+# blocksize we propose to the server for protocol 10
+BLOCK_SIZE = 1000000
+
+# upper bound on the number of buffers handed to a single sendmsg call,
+# stays well below IOV_MAX on the platforms we support
+MAX_SEND_BUFFERS = 512
+
+# kernel socket buffer size for TCP connections, None keeps the system
+# default. On Linux an explicit size disables buffer autotuning and is clamped
+# to net.core.rmem_max/wmem_max, so only set this where those limits allow
+# more than autotuning would reach.
+SOCKET_BUFFER_SIZE = None
+
+# size of the receive buffer in front of the socket, large enough for a full
+# block plus the start of the next one so consecutive chunks are parsed from
+# memory and refilled with few large recv calls
+READ_BUFFER_SIZE = 2 * BLOCK_SIZE
+
 MSG_PROMPT = b""
 MSG_MORE = b"\1\2\n"
 MSG_INFO = b"#"
@@ -70,16 +101,20 @@ MSG_TUPLE_NOSLICE = b"="
 MSG_REDIRECT = b"^"
 MSG_OK = b"=OK"
 
+# first bytes of responses that are handed back to the caller as is
+RESULT_PREFIXES = frozenset((MSG_Q, MSG_HEADER, MSG_TUPLE, MSG_NEW_RESULT_HEADER,
+                             MSG_INITIAL_RESULT_CHUNK, MSG_RESULT_CHUNK))
+
 STATE_INIT = 0
 STATE_READY = 1
 
 
 # MonetDB error codes
 errors = {
-    '42S02!': OperationalError,  # no such table
-    'M0M29!': IntegrityError,    # INSERT INTO: UNIQUE constraint violated
-    '2D000!': IntegrityError,    # COMMIT: failed
-    '40000!': IntegrityError,    # DROP TABLE: FOREIGN KEY constraint violated
+    b'42S02!': OperationalError,  # no such table
+    b'M0M29!': IntegrityError,    # INSERT INTO: UNIQUE constraint violated
+    b'2D000!': IntegrityError,    # COMMIT: failed
+    b'40000!': IntegrityError,    # DROP TABLE: FOREIGN KEY constraint violated
 }
 
 
@@ -87,7 +122,7 @@ def handle_error(error):
     """Return exception matching error code.
 
     args:
-        error (str): error string, potentially containing mapi error code
+        error (bytes): error string, potentially containing mapi error code
 
     returns:
         tuple (Exception, formatted error): returns OperationalError if unknown
@@ -95,8 +130,9 @@ def handle_error(error):
 
     """
 
-    if len(error) > 6 and error[:6] in errors:
-        return errors[error[:6]], error[6:]
+    exception = errors.get(error[:6])
+    if exception is not None and len(error) > 6:
+        return exception, error[6:]
     else:
         return OperationalError, error
 
@@ -106,6 +142,15 @@ class Connection(object):
     """
     MAPI (low level MonetDB API) connection
     """
+    __slots__ = ('state', '_result', 'socket', 'hostname', 'port',
+                 'username', 'password', 'database', 'language', 'protocol',
+                 'compression', 'allow_compression', 'endianness',
+                 'blocksize', 'unix_socket',
+                 '_send_buffer', '_recv_view', '_recv_head', '_recv_tail',
+                 '_parts',
+                 '_header', '_chunk_size', '_compress', '_decompress',
+                 '__weakref__')
+
     def __init__(self):
         self.state = STATE_INIT
         self._result = None
@@ -118,16 +163,33 @@ class Connection(object):
         self.language = ""
         self.protocol = Protocol.prot9
         self.compression = Compression.none
+        self.allow_compression = True
         self.endianness = get_byte_order()
         self.blocksize = -1
+        self._send_buffer = bytearray(PROT10_HEADER.size + MAX_PACKAGE_LENGTH)
+        # bytes between head and tail are received but not consumed yet
+        self._recv_view = memoryview(bytearray(READ_BUFFER_SIZE))
+        self._recv_head = 0
+        self._recv_tail = 0
+        # chunks of a block whose read was interrupted by a socket timeout,
+        # None if the connection can't resume that read
+        self._parts = []
+        self._set_block_format()
 
     def connect(self, database, username, password, language, hostname=None,
-                port=None, unix_socket=None):
+                port=None, unix_socket=None, compression=True):
         """ setup connection to MAPI server
 
-        unix_socket is used if hostname is not defined.
+        unix_socket is used if hostname is not defined. With compression
+        disabled no compression is negotiated, even if the server offers it.
         """
 
+        # a redirect or control command reuses this object, the handshake
+        # of the new connection always starts with uncompressed prot9 blocks
+        self.protocol = Protocol.prot9
+        self.compression = Compression.none
+        self._set_block_format()
+
         if hostname and hostname[:1] == '/' and not unix_socket:
             unix_socket = '%s/.s.monetdb.%d' % (hostname, port)
             hostname = None
@@ -143,19 +205,29 @@ class Connection(object):
         self.database = database
         self.language = language
         self.unix_socket = unix_socket
+        self.allow_compression = compression
 
         if hostname:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # For performance, mirror MonetDB/src/common/stream.c socket settings.
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 0)
             self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if SOCKET_BUFFER_SIZE:
+                # set before connecting so the TCP window scale is negotiated
+                # accordingly
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
             self.socket.connect((hostname, port))
         else:
             self.socket = socket.socket(socket.AF_UNIX)
             self.socket.connect(unix_socket)
             if self.language != 'control':
                 # don't know why, but we need to do this
-                self.socket.send(encode('0'))
+                self.socket.sendall(b'0')
+
+        self._recv_head = 0
+        self._recv_tail = 0
+        self._parts = []
 
         if not (self.language == 'control' and not self.hostname):
             # control doesn't require authentication over socket
@@ -168,11 +240,12 @@ class Connection(object):
         everything is okay """
 
         challenge = self._getblock().decode('utf-8')
-        self.blocksize = 1000000
+        self.blocksize = BLOCK_SIZE
         (response, protocol, compression) = self._challenge_response(challenge, self.blocksize)
         self._putblock(response.encode('utf-8'))
         self.protocol = protocol
         self.compression = compression
+        self._set_block_format()
         prompt = self._getblock().strip()
 
         if len(prompt) == 0:
@@ -208,7 +281,8 @@ class Connection(object):
                 self.socket.close()
                 self.connect(hostname=self.hostname, port=self.port,
                              username=self.username, password=self.password,
-                             database=self.database, language=self.language)
+                             database=self.database, language=self.language,
+                             compression=self.allow_compression)
 
             else:
                 raise ProgrammingError("unknown redirect: %s" % prompt)
@@ -225,7 +299,7 @@ class Connection(object):
         response = self._getblock()
         if not len(response):
             return ""
-        if response.startswith(MSG_OK):
+        if response[:3] == MSG_OK:
             return response[3:].strip() or ""
         if response == MSG_MORE:
             # tell server it isn't going to get more
@@ -234,25 +308,25 @@ class Connection(object):
         # If we are performing an update test for errors such as a failed
         # transaction.
 
-        # We are splitting the response into lines and checking each one if it
-        # starts with MSG_ERROR. If this is the case, find which line records
-        # the error and use it to call handle_error.
-        if response[:2] == MSG_QUPDATE:
-            lines = response.split(b'\n')
-            if any([l.startswith(MSG_ERROR) for l in lines]):
-                index = next(i for i, v in enumerate(lines) if v.startswith(MSG_ERROR))
-                exception, string = handle_error(lines[index][1:])
-                raise exception(string)
-
-        if response[0:1] in [MSG_Q, MSG_HEADER, MSG_TUPLE, MSG_NEW_RESULT_HEADER, MSG_INITIAL_RESULT_CHUNK, MSG_RESULT_CHUNK]:
+        # Error lines start with MSG_ERROR, only if the response contains one
+        # we split it into lines and use the first error line to call
+        # handle_error.
+        if response[:2] == MSG_QUPDATE and b'\n' + MSG_ERROR in response:
+            for line in response.split(b'\n'):
+                if line.startswith(MSG_ERROR):
+                    exception, string = handle_error(line[1:])
+                    raise exception(string)
+
+        first = response[:1]
+        if first in RESULT_PREFIXES:
             return response
-        elif response[0:1] == MSG_ERROR:
+        elif first == MSG_ERROR:
             exception, string = handle_error(response[1:])
             raise exception(string)
-        elif response[0:1] == MSG_INFO:
+        elif first == MSG_INFO:
             logger.info("%s" % (response[1:]))
         elif self.language == 'control' and not self.hostname:
-            if response.startswith("OK"):
+            if response.startswith(b"OK"):
                 return response[2:].strip() or ""
             else:
                 return response
@@ -265,9 +339,9 @@ class Connection(object):
         logger.debug("executing command %s" % operation)
 
         if self.state != STATE_READY:
-            raise(ProgrammingError, "Not connected")
+            raise ProgrammingError("Not connected")
 
-        self._putblock(operation.encode('utf-8') if PY3 else operation)
+        self._putblock(operation.encode('utf-8'))
         return self.read_response()
 
     def _challenge_response(self, challenge, blocksize):
@@ -279,25 +353,18 @@ class Connection(object):
         if protocol == '9':
             algo = challenges[5]
             try:
-                h = hashlib.new(algo)
-                h.update(password.encode())
-                password = h.hexdigest()
+                password = hashlib.new(algo, password.encode()).hexdigest()
             except ValueError as e:
-                raise NotSupportedError(e.message)
+                raise NotSupportedError(str(e))
         else:
             raise NotSupportedError("We only speak protocol v9")
 
+        salted = (password + salt).encode()
         h = hashes.split(",")
         if "SHA1" in h:
-            s = hashlib.sha1()
-            s.update(password.encode())
-            s.update(salt.encode())
-            pwhash = "{SHA1}" + s.hexdigest()
+            pwhash = "{SHA1}" + hashlib.sha1(salted).hexdigest()
         elif "MD5" in h:
-            m = hashlib.md5()
-            m.update(password.encode())
-            m.update(salt.encode())
-            pwhash = "{MD5}" + m.hexdigest()
+            pwhash = "{MD5}" + hashlib.md5(salted).hexdigest()
         else:
             raise NotSupportedError("Unsupported hash algorithms required"
                                     " for login: %s" % hashes)
@@ -309,12 +376,46 @@ class Connection(object):
             # protocol 10 is supported
             protocol = Protocol.prot10
             _compression = "COMPRESSION_NONE"
-            if self.hostname != "localhost" and "COMPRESSION_SNAPPY" in h and HAVE_SNAPPY:
+            if self.allow_compression and "COMPRESSION_LZ4" in h and HAVE_LZ4:
+                # lz4 is fast enough to pay off even on localhost
+                _compression = "COMPRESSION_LZ4"
+                compression = Compression.lz4
+            elif self.allow_compression and self.hostname and self.hostname != "localhost" \
+                    and "COMPRESSION_SNAPPY" in h and HAVE_SNAPPY:
+                # snappy only for remote hosts, hostname is None for unix
+                # domain sockets
                 _compression = "COMPRESSION_SNAPPY"
                 compression = Compression.snappy
             response = ["LIT" if  self.endianness == Endianness.little else "BIG", self.username, pwhash, self.language, self.database, "PROT10", _compression, str(blocksize)]
         return (":".join(response) + ":", protocol, compression)
 
+    def _set_block_format(self):
+        """ select the chunk header format and (de)compression functions for
+        the current protocol and compression once, instead of for every
+        chunk """
+        if self.protocol == Protocol.prot9:
+            self._header = PROT9_HEADER
+        else:
+            self._header = PROT10_HEADER
+
+        # compressed chunks may hold up to the negotiated blocksize, the
+        # input is sized so even incompressible data stays below it
+        if self.compression == Compression.snappy:
+            # snappy's worst case is 32 + n + n / 6 bytes
+            self._chunk_size = (self.blocksize - 32) * 6 // 7
+            self._compress = snappy.compress
+            self._decompress = snappy.uncompress
+        elif self.compression == Compression.lz4:
+            # LZ4_compressBound(n) is n + n / 255 + 16 bytes
+            self._chunk_size = (self.blocksize - 16) * 255 // 256
+            self._compress = partial(lz4.block.compress, mode='fast', store_size=False)
+            # chunks are raw lz4 blocks of at most blocksize bytes
+            self._decompress = partial(lz4.block.decompress, uncompressed_size=self.blocksize)
+        else:
+            self._chunk_size = MAX_PACKAGE_LENGTH
+            self._compress = None
+            self._decompress = None
+
     def _getblock(self):
         """ read one mapi encoded block """
         if (self.language == 'control' and not self.hostname):
@@ -323,72 +424,208 @@ class Connection(object):
             return self._getblock_inet()
 
     def _getblock_inet(self):
-        result = BytesIO()
+        parts = self._parts
+        if parts is None:
+            raise OperationalError("Connection is unusable after an "
+                                   "interrupted read")
+        header_size = self._header.size
+        unpack_from = self._header.unpack_from
+        view = self._recv_view
+        fill = self._fill
+        decompress = self._decompress
+
+        # a chunk is only consumed once it is completely buffered, a socket
+        # timeout leaves it in the receive buffer and the chunks before it
+        # in self._parts, so the next call resumes the same block
         last = 0
         while not last:
-            if self.protocol == Protocol.prot9:
-                flag = self._getbytes(2)
-                unpacked = struct.unpack('<H', flag)[0]  # little endian short
-                length = unpacked >> 1
-                last = unpacked & 1
+            fill(header_size)
+            unpacked = unpack_from(view, self._recv_head)[0]
+            length = unpacked >> 1
+            last = unpacked & 1
+            if header_size + length <= len(view):
+                fill(header_size + length)
+                start = self._recv_head + header_size
+                self._recv_head = start + length
+                if length == 0:
+                    continue
+                if decompress is not None:
+                    # decompress straight from the receive buffer, without
+                    # copying the compressed chunk out first
+                    block = decompress(view[start:start + length])
+                else:
+                    block = bytes(view[start:start + length])
             else:
-                flag = self._getbytes(8)
-                unpacked = struct.unpack('<q', flag)[0]  # little endian long long
-                length = unpacked >> 1
-                last = unpacked & 1
-            if length > 0:
-                block = self._getbytes(length)
-                if self.compression == Compression.snappy:
-                    block = snappy.uncompress(block)
-                result.write(block)
-        return result.getvalue()
+                self._recv_head += header_size
+                try:
+                    block = self._getbytes(length)
+                except socket.timeout:
+                    # part of the chunk is lost, we can't resume this block
+                    self._parts = None
+                    raise
+                if decompress is not None:
+                    block = decompress(block)
+            parts.append(block)
+
+        self._parts = []
+        if len(parts) == 1:
+            # most responses fit in a single chunk, no need to copy it
+            return parts[0]
+        return b''.join(parts)
 
     def _getblock_socket(self):
-        buffer = BytesIO()
+        view = self._recv_view
+        result = bytearray(view[self._recv_head:self._recv_tail])
+        self._recv_head = self._recv_tail = 0
         while True:
-            x = self.socket.recv(1)
-            if len(x):
-                buffer.write(x)
-            else:
+            received = self.socket.recv_into(view)
+            if not received:
                 break
-        return buffer.getvalue().strip()
+            result += view[:received]
+        return bytes(result).strip()
+
+    def _fill(self, size):
+        """Make sure at least size bytes are in the receive buffer, size may
+        not exceed the buffer size"""
+        head = self._recv_head
+        tail = self._recv_tail
+        if tail - head >= size:
+            return
+        view = self._recv_view
+        if head + size > len(view):
+            # move the unconsumed bytes to the front to make room
+            view[:tail - head] = view[head:tail]
+            tail -= head
+            head = self._recv_head = 0
+            self._recv_tail = tail
+        recv_into = self.socket.recv_into
+        while tail - head < size:
+            # the cursors are kept up to date after every recv, so a socket
+            # timeout leaves the buffer consistent and the read can be retried
+            received = recv_into(view[tail:])
+            if received == 0:
+                raise OperationalError("Server closed connection")
+            tail = self._recv_tail = tail + received
 
     def _getbytes(self, bytes_):
         """Read an amount of bytes from the socket"""
-        result = BytesIO()
-        count = bytes_
-        while count > 0:
-            recv = self.socket.recv(count)
-            if len(recv) == 0:
+        view = self._recv_view
+        if bytes_ <= len(view):
+            self._fill(bytes_)
+            head = self._recv_head
+            self._recv_head = head + bytes_
+            return bytes(view[head:head + bytes_])
+
+        # larger than the receive buffer, take what is buffered and read the
+        # rest straight from the socket
+        result = bytearray(bytes_)
+        target = memoryview(result)
+        pos = self._recv_tail - self._recv_head
+        target[:pos] = view[self._recv_head:self._recv_tail]
+        self._recv_head = self._recv_tail = 0
+        while pos < bytes_:
+            received = self.socket.recv_into(target[pos:])
+            if received == 0:
                 raise OperationalError("Server closed connection")
-            count -= len(recv)
-            result.write(recv)
-        return result.getvalue()
+            pos += received
+        return bytes(result)
 
     def _putblock(self, block):
         """ wrap the line in mapi format and put it into the socket """
         if (self.language == 'control' and not self.hostname):
-            return self.socket.send(encode(block))  # control doesn't do block splitting when using a socket
+            return self.socket.sendall(block)  # control doesn't do block splitting when using a socket
         else:
             self._putblock_inet(block)
 
     def _putblock_inet(self, block):
+        header = self._header
+        compress = self._compress
+
+        chunk_size = self._chunk_size
+
+        if len(block) < chunk_size:
+            # short commands fit in a single (last) chunk
+            if compress is None:
+                # at most MAX_PACKAGE_LENGTH bytes, copying is cheaper than
+                # a second system call
+                self.socket.sendall(header.pack((len(block) << 1) + 1) + block)
+                return
+            data = compress(block)
+            flag = header.pack((len(data) << 1) + 1)
+            if hasattr(self.socket, 'sendmsg'):
+                self._sendmsg_all([flag, data])
+            else:
+                self.socket.sendall(flag)
+                self.socket.sendall(data)
+            return
+
+        # slices of a memoryview are zero-copy views on the block
+        view = memoryview(block)
+        if compress is None and hasattr(self.socket, 'sendmsg'):
+            self._putblock_inet_vectored(view, header)
+            return
+
+        buffer = self._send_buffer
+        header_size = header.size
+        pack = header.pack
+        pack_into = header.pack_into
+        sendall = self.socket.sendall
+        sendmsg = getattr(self.socket, 'sendmsg', None)
         pos = 0
         last = 0
         while not last:
-            data = block[pos:pos + MAX_PACKAGE_LENGTH]
-            if self.compression == Compression.snappy:
-                data = snappy.compress(data)
-            length = len(data)
-            if length < MAX_PACKAGE_LENGTH:
+            data = view[pos:pos + chunk_size]
+            pos += len(data)
+            if len(data) < chunk_size:
                 last = 1
-            if self.protocol == Protocol.prot9:
-                flag = struct.pack('<H', (length << 1) + last)
+            if compress is not None:
+                # compressed chunks can be up to blocksize, send them along
+                # with their header instead of copying them next to it
+                data = compress(data)
+                flag = pack((len(data) << 1) + last)
+                if sendmsg is not None:
+                    self._sendmsg_all([flag, data])
+                else:
+                    sendall(flag)
+                    sendall(data)
             else:
-                flag = struct.pack('<q', (length << 1) + last) # little endian
-            self.socket.send(flag)
-            self.socket.send(data)
-            pos += length
+                total = header_size + len(data)
+                pack_into(buffer, 0, (len(data) << 1) + last)
+                buffer[header_size:total] = data
+                sendall(memoryview(buffer)[:total])
+
+    def _putblock_inet_vectored(self, view, header):
+        """ send all chunks of an uncompressed block with scatter-gather
+        writes instead of one system call per chunk, view is a memoryview
+        on the block """
+        pack = header.pack
+        buffers = []
+        append = buffers.append
+        pos = 0
+        last = 0
+        while not last:
+            data = view[pos:pos + MAX_PACKAGE_LENGTH]
+            pos += len(data)
+            if len(data) < MAX_PACKAGE_LENGTH:
+                last = 1
+            append(pack((len(data) << 1) + last))
+            append(data)
+        self._sendmsg_all(buffers)
+
+    def _sendmsg_all(self, buffers):
+        """ write all buffers to the socket with as few sendmsg calls as
+        possible """
+        sendmsg = self.socket.sendmsg
+        index = 0
+        while index < len(buffers):
+            sent = sendmsg(buffers[index:index + MAX_SEND_BUFFERS])
+            # skip the buffers that went out completely and resume a
+            # partially sent one where the kernel stopped
+            while index < len(buffers) and sent >= len(buffers[index]):
+                sent -= len(buffers[index])
+                index += 1
+            if sent:
+                buffers[index] = memoryview(buffers[index])[sent:]
 
     def __del__(self):
         if self.socket:
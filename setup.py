@@ -30,15 +30,14 @@ setup(name='pymonetdb',
           "Development Status :: 5 - Production/Stable",
           "Intended Audience :: Developers",
           "License :: OSI Approved :: Mozilla Public License 2.0 (MPL 2.0)",
-          "Programming Language :: Python :: 2",
           "Programming Language :: Python :: 3",
-          "Programming Language :: Python :: 2.6",
-          "Programming Language :: Python :: 2.7",
+          "Programming Language :: Python :: 3 :: Only",
           "Programming Language :: Python :: 3.4",
           "Programming Language :: Python :: 3.5",
           "Programming Language :: Python :: 3.6",
           "Programming Language :: Python :: Implementation :: PyPy",
       ],
+      python_requires='>=3.4',
       install_requires=[
           'six'
       ]
@@ -0,0 +1,412 @@
+import os
+import socket
+import threading
+import unittest
+from mock import patch
+import pymonetdb
+from pymonetdb import mapi
+from pymonetdb.mapi import Connection, Protocol, Compression, \
+    MAX_PACKAGE_LENGTH, MAX_SEND_BUFFERS, BLOCK_SIZE, PROT9_HEADER, \
+    PROT10_HEADER
+
+CHALLENGE = 'salt:merovingian:9:RIPEMD160,SHA256,SHA1,MD5,PROT10,%s:LIT:SHA512:'
+
+
+class ShortWriteSocket(object):
+    """Socket stand-in that records everything sent and lets sendmsg only
+       write a few bytes per call, like a kernel with a full send buffer.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.calls = 0
+        self.buffer_counts = []
+        self.data = bytearray()
+
+    def sendmsg(self, buffers):
+        self.buffer_counts.append(len(buffers))
+        budget = self.limits[self.calls % len(self.limits)]
+        self.calls += 1
+        sent = 0
+        for buf in buffers:
+            part = bytes(buf[:budget - sent])
+            self.data += part
+            sent += len(part)
+            if sent == budget:
+                break
+        return sent
+
+    def sendall(self, data):
+        self.data += data
+
+    def close(self):
+        pass
+
+
+def split_chunks(data, header):
+    """Split a MAPI encoded message into its (length, last) chunks and payload"""
+    chunks = []
+    payload = bytearray()
+    pos = 0
+    while pos < len(data):
+        unpacked = header.unpack_from(data, pos)[0]
+        pos += header.size
+        length = unpacked >> 1
+        chunks.append((length, unpacked & 1))
+        payload += data[pos:pos + length]
+        pos += length
+    return chunks, bytes(payload)
+
+
+class PutblockTest(unittest.TestCase):
+    """The multi chunk send path hands all chunks to a single sendmsg call and
+       has to resume correctly when the kernel only takes part of them.
+    """
+
+    def _send(self, block, protocol, limits):
+        sock = ShortWriteSocket(limits)
+        c = Connection()
+        c.socket = sock
+        c.hostname = 'localhost'
+        c.language = 'sql'
+        c.protocol = protocol
+        c._set_block_format()
+        c._putblock(block)
+        return sock
+
+    def _check(self, size, protocol, limits):
+        header = PROT9_HEADER if protocol == Protocol.prot9 else PROT10_HEADER
+        block = bytes(bytearray(i % 251 for i in range(size)))
+        sock = self._send(block, protocol, limits)
+
+        chunks, payload = split_chunks(bytes(sock.data), header)
+        self.assertEqual(payload, block)
+        self.assertEqual([last for _, last in chunks], [0] * (len(chunks) - 1) + [1])
+        for length, _ in chunks[:-1]:
+            self.assertEqual(length, MAX_PACKAGE_LENGTH)
+        self.assertTrue(chunks[-1][0] < MAX_PACKAGE_LENGTH)
+        for count in sock.buffer_counts:
+            self.assertTrue(count <= MAX_SEND_BUFFERS)
+        return sock
+
+    def test_chunk_boundaries(self):
+        for protocol in (Protocol.prot9, Protocol.prot10):
+            for size in (0, 1, MAX_PACKAGE_LENGTH - 1, MAX_PACKAGE_LENGTH,
+                         MAX_PACKAGE_LENGTH + 1, 2 * MAX_PACKAGE_LENGTH,
+                         2 * MAX_PACKAGE_LENGTH + 1):
+                self._check(size, protocol, [1, 3, 8, 8191, 100000])
+
+    def test_short_writes(self):
+        # every possible split point of a small three chunk message
+        for limit in (1, 2, 7, 9, 8191, 8192, 8193):
+            self._check(2 * MAX_PACKAGE_LENGTH + 5, Protocol.prot10, [limit])
+
+    def test_max_send_buffers(self):
+        # every chunk takes two buffers, header and payload
+        chunks = MAX_SEND_BUFFERS // 2
+        for size in (chunks * MAX_PACKAGE_LENGTH - 1,
+                     chunks * MAX_PACKAGE_LENGTH,
+                     chunks * MAX_PACKAGE_LENGTH + 1,
+                     3 * chunks * MAX_PACKAGE_LENGTH):
+            sock = self._check(size, Protocol.prot9, [10 ** 9])
+            self.assertEqual(max(sock.buffer_counts), MAX_SEND_BUFFERS)
+            self._check(size, Protocol.prot10, [8191, 777777])
+
+
+class TimeoutTest(unittest.TestCase):
+    """Connection.settimeout() is public API, a read that timed out should not
+       leave the MAPI connection unusable.
+    """
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+        self.c = Connection()
+        self.c.socket = self.client
+        self.c.hostname = 'localhost'
+        self.c.language = 'sql'
+        self.c.protocol = Protocol.prot10
+        self.c._set_block_format()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_read_after_timeout(self):
+        self.client.settimeout(0.01)
+        self.assertRaises(socket.timeout, self.c._getblock)
+
+        response = b'&1 0 0 0 0\n'
+        self.server.sendall(PROT10_HEADER.pack((len(response) << 1) + 1) + response)
+        self.assertEqual(self.c._getblock(), response)
+
+    def test_timeout_in_chunk_header(self):
+        self.client.settimeout(0.01)
+        response = b'=OK'
+        message = PROT10_HEADER.pack((len(response) << 1) + 1) + response
+        self.server.sendall(message[:3])
+        self.assertRaises(socket.timeout, self.c._getblock)
+
+        # the part of the header that did arrive is kept
+        self.server.sendall(message[3:])
+        self.assertEqual(self.c._getblock(), response)
+
+    def test_timeout_between_chunks(self):
+        self.client.settimeout(0.01)
+        self.server.sendall(PROT10_HEADER.pack(10 << 1) + b'A' * 10)
+        self.assertRaises(socket.timeout, self.c._getblock)
+
+        # the chunk read before the timeout is part of the same block
+        self.server.sendall(PROT10_HEADER.pack((10 << 1) + 1) + b'B' * 10)
+        self.assertEqual(self.c._getblock(), b'A' * 10 + b'B' * 10)
+
+    def test_timeout_in_chunk(self):
+        self.client.settimeout(0.01)
+        self.server.sendall(PROT10_HEADER.pack((10 << 1) + 1) + b'A' * 4)
+        self.assertRaises(socket.timeout, self.c._getblock)
+
+        self.server.sendall(b'A' * 6)
+        self.assertEqual(self.c._getblock(), b'A' * 10)
+
+    @patch('pymonetdb.mapi.READ_BUFFER_SIZE', 64)
+    def test_timeout_in_oversized_chunk(self):
+        c = Connection()
+        c.socket = self.client
+        c.hostname = 'localhost'
+        c.language = 'sql'
+        c.protocol = Protocol.prot10
+        c._set_block_format()
+
+        # a chunk larger than the receive buffer can't be resumed
+        self.client.settimeout(0.01)
+        self.server.sendall(PROT10_HEADER.pack((100 << 1) + 1) + b'A' * 80)
+        self.assertRaises(socket.timeout, c._getblock)
+
+        self.server.sendall(b'A' * 20)
+        self.assertRaises(pymonetdb.OperationalError, c._getblock)
+
+
+class ReconnectTest(unittest.TestCase):
+    """A redirect and the control commands call connect() again on the same
+       object, the handshake must not use the previous block format.
+    """
+
+    @patch('pymonetdb.mapi.socket.socket')
+    @patch.object(Connection, '_login')
+    def test_connect_resets_block_format(self, login, _):
+        c = Connection()
+        c.protocol = Protocol.prot10
+        c.compression = Compression.snappy
+        c._header = PROT10_HEADER
+        c._compress = c._decompress = len
+
+        def check_login():
+            self.assertEqual(c.protocol, Protocol.prot9)
+            self.assertEqual(c.compression, Compression.none)
+            self.assertTrue(c._header is PROT9_HEADER)
+            self.assertTrue(c._compress is None and c._decompress is None)
+
+        login.side_effect = check_login
+        c.connect(database='demo', username='monetdb', password='monetdb',
+                  language='sql', hostname='example.org', port=50000)
+        self.assertEqual(login.call_count, 1)
+
+
+class Lz4Test(unittest.TestCase):
+    """LZ4 is preferred over snappy when both the server and the client
+       support it, chunks are raw lz4 blocks without a size prefix.
+    """
+
+    def _connection(self, hostname='example.org'):
+        c = Connection()
+        c.hostname = hostname
+        c.username = 'monetdb'
+        c.password = 'monetdb'
+        c.language = 'sql'
+        c.database = 'demo'
+        return c
+
+    @patch('pymonetdb.mapi.HAVE_SNAPPY', True)
+    @patch('pymonetdb.mapi.HAVE_LZ4', True)
+    def test_lz4_preferred(self):
+        c = self._connection()
+        challenge = CHALLENGE % 'COMPRESSION_SNAPPY,COMPRESSION_LZ4'
+        response, protocol, compression = c._challenge_response(challenge, BLOCK_SIZE)
+        self.assertEqual(protocol, Protocol.prot10)
+        self.assertEqual(compression, Compression.lz4)
+        self.assertTrue(':PROT10:COMPRESSION_LZ4:' in response)
+
+    @patch('pymonetdb.mapi.HAVE_SNAPPY', True)
+    @patch('pymonetdb.mapi.HAVE_LZ4', False)
+    def test_lz4_not_installed(self):
+        c = self._connection()
+        challenge = CHALLENGE % 'COMPRESSION_SNAPPY,COMPRESSION_LZ4'
+        response, protocol, compression = c._challenge_response(challenge, BLOCK_SIZE)
+        self.assertEqual(compression, Compression.snappy)
+        self.assertTrue(':PROT10:COMPRESSION_SNAPPY:' in response)
+
+        challenge = CHALLENGE % 'COMPRESSION_LZ4'
+        response, protocol, compression = c._challenge_response(challenge, BLOCK_SIZE)
+        self.assertEqual(compression, Compression.none)
+        self.assertTrue(':PROT10:COMPRESSION_NONE:' in response)
+
+    @patch('pymonetdb.mapi.HAVE_SNAPPY', True)
+    @patch('pymonetdb.mapi.HAVE_LZ4', False)
+    def test_snappy_remote_only(self):
+        challenge = CHALLENGE % 'COMPRESSION_SNAPPY'
+        for hostname, expected in (('example.org', Compression.snappy),
+                                   ('localhost', Compression.none),
+                                   (None, Compression.none)):  # unix socket
+            c = self._connection(hostname)
+            response, protocol, compression = c._challenge_response(challenge, BLOCK_SIZE)
+            self.assertEqual(compression, expected)
+
+    @patch('pymonetdb.mapi.HAVE_SNAPPY', True)
+    @patch('pymonetdb.mapi.HAVE_LZ4', True)
+    def test_compression_disabled(self):
+        c = self._connection()
+        c.allow_compression = False
+        challenge = CHALLENGE % 'COMPRESSION_SNAPPY,COMPRESSION_LZ4'
+        response, protocol, compression = c._challenge_response(challenge, BLOCK_SIZE)
+        self.assertEqual(protocol, Protocol.prot10)
+        self.assertEqual(compression, Compression.none)
+        self.assertTrue(':PROT10:COMPRESSION_NONE:' in response)
+
+    @unittest.skipUnless(mapi.HAVE_LZ4, "lz4 not installed")
+    def test_single_chunk(self):
+        import lz4.block
+
+        block = b'x' * (BLOCK_SIZE // 2)
+        sock = ShortWriteSocket([7])
+        writer = self._connection()
+        writer.socket = sock
+        writer.protocol = Protocol.prot10
+        writer.compression = Compression.lz4
+        writer.blocksize = BLOCK_SIZE
+        writer._set_block_format()
+        writer._putblock(block)
+
+        # header and compressed chunk are sent without concatenating them
+        self.assertEqual(sock.buffer_counts[0], 2)
+        chunks, payload = split_chunks(bytes(sock.data), PROT10_HEADER)
+        self.assertEqual(chunks, [(len(payload), 1)])
+        self.assertEqual(lz4.block.decompress(payload, uncompressed_size=BLOCK_SIZE), block)
+
+    @unittest.skipUnless(mapi.HAVE_LZ4 and mapi.HAVE_SNAPPY,
+                         "lz4 or snappy not installed")
+    def test_incompressible(self):
+        # random data grows when compressed, chunks must still fit blocksize
+        block = os.urandom(3 * BLOCK_SIZE)
+        for compression in (Compression.lz4, Compression.snappy):
+            sock = ShortWriteSocket([10 ** 9])
+            writer = self._connection()
+            writer.socket = sock
+            writer.protocol = Protocol.prot10
+            writer.compression = compression
+            writer.blocksize = BLOCK_SIZE
+            writer._set_block_format()
+            writer._putblock(block)
+
+            chunks, _ = split_chunks(bytes(sock.data), PROT10_HEADER)
+            self.assertTrue(len(chunks) > 3)
+            for length, _ in chunks:
+                self.assertTrue(length <= BLOCK_SIZE)
+
+    @unittest.skipUnless(mapi.HAVE_LZ4, "lz4 not installed")
+    def test_round_trip(self):
+        import lz4.block
+
+        block = ''.join('%d,\t%d\n' % (i, i * i) for i in range(300000)).encode()
+        self.assertTrue(len(block) > 2 * BLOCK_SIZE)
+
+        sock = ShortWriteSocket([10 ** 9])
+        writer = self._connection()
+        writer.socket = sock
+        writer.protocol = Protocol.prot10
+        writer.compression = Compression.lz4
+        writer.blocksize = BLOCK_SIZE
+        writer._set_block_format()
+        writer._putblock(block)
+        data = bytes(sock.data)
+
+        # every chunk is a raw lz4 block of at most blocksize bytes
+        pos = 0
+        chunks = []
+        while pos < len(data):
+            unpacked = PROT10_HEADER.unpack_from(data, pos)[0]
+            pos += PROT10_HEADER.size
+            chunks.append(data[pos:pos + (unpacked >> 1)])
+            pos += unpacked >> 1
+        chunk_size = writer._chunk_size
+        self.assertEqual(len(chunks), len(block) // chunk_size + 1)
+        decompressed = [lz4.block.decompress(chunk, uncompressed_size=BLOCK_SIZE)
+                        for chunk in chunks]
+        self.assertEqual([len(d) for d in decompressed[:-1]],
+                         [chunk_size] * (len(chunks) - 1))
+        self.assertEqual(b''.join(decompressed), block)
+
+        client, server = socket.socketpair()
+        try:
+            reader = self._connection()
+            reader.socket = client
+            reader.protocol = Protocol.prot10
+            reader.compression = Compression.lz4
+            reader.blocksize = BLOCK_SIZE
+            reader._set_block_format()
+            sender = threading.Thread(target=server.sendall, args=(data,))
+            sender.start()
+            self.assertEqual(reader._getblock(), block)
+            sender.join()
+        finally:
+            client.close()
+            server.close()
+
+
+class SnappyTest(unittest.TestCase):
+    """Snappy chunks are decompressed straight from the receive buffer, or
+       read separately when they don't fit in it.
+    """
+
+    def _connection(self, socket):
+        c = Connection()
+        c.socket = socket
+        c.hostname = 'example.org'
+        c.language = 'sql'
+        c.protocol = Protocol.prot10
+        c.compression = Compression.snappy
+        c.blocksize = BLOCK_SIZE
+        c._set_block_format()
+        return c
+
+    def _round_trip(self, block):
+        client, server = socket.socketpair()
+        try:
+            writer = self._connection(server)
+            reader = self._connection(client)
+            sender = threading.Thread(target=writer._putblock, args=(block,))
+            sender.start()
+            self.assertEqual(reader._getblock(), block)
+            sender.join()
+        finally:
+            client.close()
+            server.close()
+
+    @unittest.skipUnless(mapi.HAVE_SNAPPY, "snappy not installed")
+    def test_round_trip(self):
+        block = ''.join('%d,\t%d\n' % (i, i * i) for i in range(300000)).encode()
+        self.assertTrue(len(block) > 2 * BLOCK_SIZE)
+        for data in (b'', b'=OK', block):
+            self._round_trip(data)
+
+    @unittest.skipUnless(mapi.HAVE_SNAPPY, "snappy not installed")
+    @patch('pymonetdb.mapi.READ_BUFFER_SIZE', 10000)
+    def test_chunk_larger_than_buffer(self):
+        import snappy
+
+        block = ''.join('%d,\t%d\n' % (i, i * i) for i in range(300000)).encode()
+        self.assertTrue(len(snappy.compress(block[:BLOCK_SIZE // 2])) > 10000)
+        self._round_trip(block)
+        self._round_trip(os.urandom(BLOCK_SIZE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -36,16 +36,19 @@ class MultilineResponseTest(unittest.TestCase):
            that a transaction has failed due to concurrency conflicts.
         """
         query_text = 'sINSERT INTO tbl VALUES (1)'
-        response = "&2 1 -1\n!40000!COMMIT: transaction is aborted because of concurrency conflicts, will ROLLBACK instead\n"
-        error_message = "40000!COMMIT: transaction is aborted because of concurrency conflicts, will ROLLBACK instead"
+        response = b"&2 1 -1\n!40000!COMMIT: transaction is aborted because of concurrency conflicts, will ROLLBACK instead\n"
+        error_message = b"COMMIT: transaction is aborted because of concurrency conflicts, will ROLLBACK instead"
         mock_getblock.return_value = response
         c = pymonetdb.mapi.Connection()
 
         # Simulate a connection
         c.state = pymonetdb.mapi.STATE_READY
 
-        # Make sure that cmd raises the correct exception
-        self.assertRaises(pymonetdb.IntegrityError, c.cmd, [query_text])
+        # Make sure that cmd raises the correct exception, the error code
+        # is stripped from the message
+        with self.assertRaises(pymonetdb.IntegrityError) as cm:
+            c.cmd(query_text)
+        self.assertEqual(cm.exception.args[0], error_message)
 
 if __name__ == "__main__":
     unittest.main()